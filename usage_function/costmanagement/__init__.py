@@ -1,8 +1,11 @@
 """An Azure function to collect cost-management information."""
 
 import logging
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Final
+from typing import Final, Optional
 
 import azure.functions as func
 import requests
@@ -17,11 +20,13 @@ from azure.mgmt.costmanagement.models import (
     QueryTimePeriod,
     TimeframeType,
 )
+from pydantic import TypeAdapter
 from rctab_models import models
 
 import utils.settings
-from utils.auth import BearerAuth
+from utils.auth import get_auth
 from utils.logutils import add_log_handler_once
+from utils.retry import backoff_delay, is_retryable
 
 logging.basicConfig(
     level=logging.WARNING,
@@ -31,9 +36,33 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 RETRY_ATTEMPTS: Final = 5
+# The most time windows to query Azure for at once. More may get us throttled.
+MAX_QUERY_WORKERS: Final = 8
 # We should only need one set of credentials
 CREDENTIALS: Final = DefaultAzureCredential()
 
+# Reuse connections, rather than doing a TCP and TLS handshake for every request.
+# requests doesn't document Session as thread-safe, but the query workers' page
+# requests share this one on purpose. It is only used for stateless POSTs that
+# pass their own auth, and its settings are never changed, so all they share is
+# urllib3's thread-safe connection pool.
+SESSION: Final = requests.Session()
+
+# Serialises AllCMUsage straight to UTF-8 encoded JSON bytes.
+ALL_CM_USAGE_ADAPTER: Final = TypeAdapter(models.AllCMUsage)
+
+# Windows that ended at least this long ago are cached between invocations. Azure
+# can still amend their costs, e.g. with EA or MCA adjustments, so this trades
+# costs up to WINDOW_CACHE_TTL out of date for fewer queries.
+CLOSED_WINDOW_AGE: Final = timedelta(days=3)
+# How many seconds to cache the rows of a closed window for.
+WINDOW_CACHE_TTL: Final = 24 * 60 * 60
+# (scope, window_start, window_end) -> (time.monotonic() expiry time, rows)
+WINDOW_CACHE: Final[dict[tuple[str, datetime, datetime], tuple[float, tuple]]] = {}
+
+# The scope to request an Azure Resource Manager access token for.
+COST_MANAGEMENT_SCOPE: Final = "https://management.azure.com/.default"
+
 # The constant parts of the Azure Cost Management API query. To be appended
 # with to/from times.
 QUERY_TYPE: Final = ExportType.ACTUAL_COST
@@ -63,7 +92,124 @@ QUERY_DATASET: Final = QueryDataset(
 
 def _truncate_date(date_time):
     """Truncate a datetime to the same date but 00:00:00 hours."""
-    return datetime(*date_time.date().timetuple()[:3])
+    return date_time.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _get_next_page(
+    next_link: str, parameters: QueryDefinition
+) -> tuple[list, Optional[str]]:
+    """Get a further page of results for a cost management query.
+
+    The SDK doesn't support paging, so we POST the query to the next link ourselves,
+    retrying transient failures.
+
+    Args:
+        next_link: The URL of the next page, as returned with the previous page.
+        parameters: The query that returned the previous page.
+
+    Return:
+        The rows of the page and the link to the page after it, if there is one.
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        token = CREDENTIALS.get_token(COST_MANAGEMENT_SCOPE).token
+        resp = SESSION.post(
+            next_link,
+            json=parameters.serialize(),
+            headers={"Authorization": f"Bearer {token}"},
+            timeout=60,
+        )
+        if (
+            resp.ok
+            or attempt == RETRY_ATTEMPTS - 1
+            or not is_retryable(resp.status_code)
+        ):
+            break
+        logger.warning(
+            "Failed to get a page of cost management data. Response code: %d.",
+            resp.status_code,
+        )
+        # Cost management queries are throttled, so respect Retry-After.
+        time.sleep(backoff_delay(attempt, resp.headers.get("Retry-After")))
+
+    resp.raise_for_status()
+    properties = resp.json()["properties"]
+    return properties.get("rows") or [], properties.get("nextLink")
+
+
+def _fetch_window(
+    cm_client: CostManagementClient,
+    scope: str,
+    window_start: datetime,
+    window_end: datetime,
+) -> list:
+    """Get every row of cost management data for one time window from Azure.
+
+    Args:
+        cm_client: The client to query with.
+        scope: The scope to query.
+        window_start: The first day of the window.
+        window_end: The last day of the window, inclusive.
+
+    Return:
+        The rows of all pages of results.
+    """
+    parameters = QueryDefinition(
+        time_period=QueryTimePeriod(from_property=window_start, to=window_end),
+        dataset=QUERY_DATASET,
+        type=QUERY_TYPE,
+        timeframe=QUERY_TIMEFRAME,
+    )
+    new_data = cm_client.query.usage(scope=scope, parameters=parameters)
+    if not new_data:
+        return []
+
+    rows = list(new_data.rows or [])
+    next_link = new_data.next_link
+    while next_link:
+        page_rows, next_link = _get_next_page(next_link, parameters)
+        rows.extend(page_rows)
+    return rows
+
+
+def _query_window(
+    cm_client: CostManagementClient,
+    scope: str,
+    window_start: datetime,
+    window_end: datetime,
+) -> list:
+    """Get every row of cost management data for one time window.
+
+    Windows that ended more than CLOSED_WINDOW_AGE ago are cached for
+    WINDOW_CACHE_TTL seconds, so Azure's later amendments to their costs may take
+    that long to show.
+
+    Args:
+        cm_client: The client to query with.
+        scope: The scope to query.
+        window_start: The first day of the window.
+        window_end: The last day of the window, inclusive.
+
+    Return:
+        The rows of all pages of results.
+    """
+    key = (scope, window_start, window_end)
+    now = time.monotonic()
+    cached = WINDOW_CACHE.get(key)
+    if cached is not None and cached[0] > now:
+        # A copy, so that callers can't change the cached rows.
+        return list(cached[1])
+
+    # Windows move on each month, so drop expired rows rather than letting the
+    # cache grow for as long as the worker lives. Other threads may be doing the
+    # same, hence the copy of the items and pop() rather than del.
+    for stale_key, (expiry, _) in list(WINDOW_CACHE.items()):
+        if expiry <= now:
+            WINDOW_CACHE.pop(stale_key, None)
+
+    rows = _fetch_window(cm_client, scope, window_start, window_end)
+    if window_end < _truncate_date(datetime.now()) - CLOSED_WINDOW_AGE:
+        WINDOW_CACHE[key] = (time.monotonic() + WINDOW_CACHE_TTL, tuple(rows))
+    return rows
 
 
 def get_all_usage(start_datetime: datetime, end_datetime: datetime, mgmt_group: str):
@@ -99,36 +245,31 @@ def get_all_usage(start_datetime: datetime, end_datetime: datetime, mgmt_group:
     max_timeperiod = timedelta(days=364)
     # We may have to do several queries to the Azure API, if the time period we need is
     # longer than max_timeperiod. covered_to will keep track of the last day for which
-    # we have data so far.
+    # we have a window so far.
     covered_to = start_datetime - timedelta(days=1)
-    data: dict[tuple, float] = {}
+    # Windows before the current month stop at the end of the previous month, so that
+    # they are the same from one run to the next and can be cached.
+    month_start = end_datetime.replace(day=1)
+    windows = []
     while covered_to < end_datetime:
         # The time window to cover in this query, inclusive.
         window_start = covered_to + timedelta(days=1)
         window_end = min(window_start + max_timeperiod, end_datetime)
-        parameters = QueryDefinition(
-            time_period=QueryTimePeriod(from_property=window_start, to=window_end),
-            dataset=QUERY_DATASET,
-            type=QUERY_TYPE,
-            timeframe=QUERY_TIMEFRAME,
+        if window_start < month_start:
+            window_end = min(window_end, month_start - timedelta(days=1))
+        windows.append((window_start, window_end))
+        covered_to = window_end
+
+    # The windows are independent, so query them concurrently.
+    with ThreadPoolExecutor(max_workers=MAX_QUERY_WORKERS) as executor:
+        window_rows = executor.map(
+            lambda window: _query_window(cm_client, scope, *window), windows
         )
-        new_data = cm_client.query.usage(scope=scope, parameters=parameters)
-        if new_data:
-            if new_data.next_link:
-                # TODO How to deal with paging?
-                msg = (
-                    "Cost management query returned multiple pages of results. "
-                    "The function app is not prepared to deal with this."
-                )
-                raise NotImplementedError(msg)
-            if new_data.rows:
-                for amount, sub_id, name, currency in new_data.rows:
-                    key = (sub_id, name, currency)
-                    if key in data:
-                        data[key] += amount
-                    else:
-                        data[key] = amount
-            covered_to = window_end
+
+        data: defaultdict[tuple, float] = defaultdict(float)
+        for rows in window_rows:
+            for amount, sub_id, name, currency in rows:
+                data[(sub_id, name, currency)] += amount
 
     # Convert data to a list of CMUsage objects.
     all_usage = models.AllCMUsage(
@@ -158,15 +299,21 @@ def send_usage(hostname_or_ip, all_usage):
       None
 
     Raise:
-      RuntimeError if the POST fails, despite retries.
+      RuntimeError if the POST fails, despite retries, or fails in a way that
+      retrying would not fix.
     """
     started_processing_at = datetime.now()
-    for _ in range(RETRY_ATTEMPTS):
+    # Serialise once, rather than on every attempt.
+    data = ALL_CM_USAGE_ADAPTER.dump_json(all_usage)
+    auth = get_auth()
+    token_cleared = False
+    for attempt in range(RETRY_ATTEMPTS):
         logger.warning("Uploading cost-management usage.")
-        resp = requests.post(
+        resp = SESSION.post(
             hostname_or_ip + "/accounting/all-cm-usage",
-            data=all_usage.model_dump_json().encode("utf-8"),
-            auth=BearerAuth(),
+            data=data,
+            headers={"Content-Type": "application/json"},
+            auth=auth,
             timeout=60,
         )
 
@@ -183,6 +330,15 @@ def send_usage(hostname_or_ip, all_usage):
             resp.status_code,
             resp.text,
         )
+        if resp.status_code == 401 and not token_cleared:
+            # The token may have expired during a slow upload, so retry once with
+            # a new one.
+            auth.clear_token()
+            token_cleared = True
+            continue
+        if attempt == RETRY_ATTEMPTS - 1 or not is_retryable(resp.status_code):
+            break
+        time.sleep(backoff_delay(attempt, resp.headers.get("Retry-After")))
 
     raise RuntimeError("Could not POST usage data.")
 
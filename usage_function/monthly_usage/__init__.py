@@ -10,7 +10,10 @@ from azure.core.exceptions import HttpResponseError
 
 import utils.settings
 from utils.logutils import add_log_handler_once
-from utils.usage import get_all_usage, retrieve_usage, send_usage
+from utils.retry import backoff_delay, is_retryable
+from utils.usage import get_all_usage, retrieve_usage, send_usage, start_run_timer
+
+logger = logging.getLogger(__name__)
 
 MAX_ATTEMPTS = 5
 
@@ -57,8 +60,8 @@ def main(mytimer: func.TimerRequest) -> None:
         datefmt="%d/%m/%Y %I:%M:%S %p",
     )
     add_log_handler_once(__name__)
-    logger = logging.getLogger(__name__)
     logger.warning("Monthly usage function starting.")
+    start_run_timer()
 
     if mytimer.past_due:
         logger.info("The timer is past due.")
@@ -73,16 +76,17 @@ def main(mytimer: func.TimerRequest) -> None:
         dates,
     )
 
+    date_from = datetime(dates[0].year, dates[0].month, dates[0].day)
+    date_to = (
+        datetime(dates[1].year, dates[1].month, dates[1].day)
+        if len(dates) == 2
+        else date_from
+    )
+
     # Try up to 5 times to get usage and send to the API
     for attempt in range(MAX_ATTEMPTS):
         logger.warning("Attempt %d", attempt + 1)
 
-        date_from = datetime(dates[0].year, dates[0].month, dates[0].day)
-        date_to = (
-            datetime(dates[1].year, dates[1].month, dates[1].day)
-            if len(dates) == 2
-            else date_from
-        )
         usage_query = get_all_usage(
             date_from,
             date_to,
@@ -104,10 +108,11 @@ def main(mytimer: func.TimerRequest) -> None:
             return
 
         except HttpResponseError as e:
-            if attempt == MAX_ATTEMPTS - 1:
+            if attempt == MAX_ATTEMPTS - 1 or not is_retryable(e.status_code):
                 logger.error("Could not retrieve usage data.")
                 raise RuntimeError("Could not retrieve usage data.")
 
-            logger.error("Request to azure failed. Trying again in 60 seconds")
+            delay = backoff_delay(attempt)
+            logger.error("Request to azure failed. Trying again in %.0f seconds", delay)
             logger.error(e)
-            time.sleep(60)
+            time.sleep(delay)
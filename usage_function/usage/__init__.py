@@ -2,6 +2,7 @@
 
 import logging
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 
 import azure.functions as func
@@ -9,7 +10,58 @@ from azure.core.exceptions import HttpResponseError
 
 import utils.settings
 from utils.logutils import add_log_handler_once
-from utils.usage import date_range, get_all_usage, retrieve_and_send_usage
+from utils.retry import backoff_delay, is_retryable
+from utils.usage import (
+    date_range_desc,
+    get_all_usage,
+    retrieve_and_send_usage,
+    start_run_timer,
+)
+
+logger = logging.getLogger(__name__)
+
+# The number of days to fetch and send concurrently. The work is I/O-bound,
+# so threads let us overlap the round trips to Azure and to the API.
+MAX_WORKERS = 8
+
+MAX_ATTEMPTS = 5
+
+
+def process_day(usage_date: datetime, config: utils.settings.Settings) -> None:
+    """Get usage for one day and send it to the API, retrying Azure failures.
+
+    Args:
+        usage_date: The day to collect usage for.
+        config: The app settings.
+
+    Raises:
+        RuntimeError: If Azure fails, despite retries, or fails in a way that
+            retrying would not fix.
+    """
+    # Try up to 5 times to get usage and send to the API
+    for attempt in range(MAX_ATTEMPTS):
+        logger.warning("Requesting all usage data for %s", usage_date)
+        usage = get_all_usage(
+            usage_date,
+            usage_date,
+            billing_account_id=config.BILLING_ACCOUNT_ID,
+            mgmt_group=config.MGMT_GROUP,
+        )
+
+        try:
+            retrieve_and_send_usage(config.API_URL, usage)
+            break
+        except HttpResponseError as e:
+            if attempt == MAX_ATTEMPTS - 1 or not is_retryable(e.status_code):
+                # Raise, so that main reports this day along with any others.
+                raise RuntimeError(
+                    f"Could not retrieve usage data for {usage_date}"
+                ) from e
+
+            delay = backoff_delay(attempt)
+            logger.error("Request to azure failed. Trying again in %.0f seconds", delay)
+            logger.error(e)
+            time.sleep(delay)
 
 
 def main(mytimer: func.TimerRequest) -> None:
@@ -25,9 +77,9 @@ def main(mytimer: func.TimerRequest) -> None:
     )
 
     add_log_handler_once(__name__)
-    logger = logging.getLogger(__name__)
 
     logger.warning("Usage function starting.")
+    start_run_timer()
 
     if mytimer.past_due:
         logger.info("The timer is past due.")
@@ -41,26 +93,25 @@ def main(mytimer: func.TimerRequest) -> None:
     end_datetime = now - timedelta(days=config.USAGE_HISTORY_DAYS_OFFSET)
 
     logger.warning(
-        "Requesting all data between %s and %s in reverse order",
+        "Requesting all data between %s and %s, newest first, %d days at a time",
         start_datetime,
         end_datetime,
+        MAX_WORKERS,
     )
 
-    for usage_date in reversed(list(date_range(start_datetime, end_datetime))):
-        # Try up to 5 times to get usage and send to the API
-        for _ in range(5):
-            logger.warning("Requesting all usage data for %s", usage_date)
-            usage = get_all_usage(
-                usage_date,
-                usage_date,
-                billing_account_id=config.BILLING_ACCOUNT_ID,
-                mgmt_group=config.MGMT_GROUP,
-            )
-
-            try:
-                retrieve_and_send_usage(config.API_URL, usage)
-                break
-            except HttpResponseError as e:
-                logger.error("Request to azure failed. Trying again in 60 seconds")
-                logger.error(e)
-                time.sleep(60)
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = {
+            executor.submit(process_day, usage_date, config): usage_date
+            for usage_date in date_range_desc(start_datetime, end_datetime)
+        }
+
+    # Every day has been attempted by now, so report all the failures.
+    failed_days = []
+    for future, usage_date in futures.items():
+        error = future.exception()
+        if error is not None:
+            logger.error("Could not process usage for %s", usage_date, exc_info=error)
+            failed_days.append(usage_date)
+
+    if failed_days:
+        raise RuntimeError(f"Could not process usage for {len(failed_days)} day(s).")
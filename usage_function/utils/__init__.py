@@ -3,5 +3,6 @@
 # pylint: disable=consider-using-from-import
 import utils.auth as auth  # noqa: F401
 import utils.logutils as logutils  # noqa: F401
+import utils.retry as retry  # noqa: F401
 import utils.settings as settings  # noqa: F401
 import utils.usage as usage  # noqa: F401
@@ -1,6 +1,9 @@
 """Authentication between usage package and API web app."""
 
-from datetime import datetime, timedelta
+import threading
+import time
+from functools import lru_cache
+from typing import Optional
 
 import jwt
 import requests
@@ -13,6 +16,23 @@ ALGORITHM = "RS256"
 # Five minutes, to allow for POSTing a lot of data or a slow web server.
 ACCESS_TOKEN_EXPIRE_MINUTES = 5
 
+# Sign a new token once the cached one has used up half of its lifetime, so that
+# a token sent with a slow upload still has plenty of time left.
+TOKEN_REFRESH_MARGIN = ACCESS_TOKEN_EXPIRE_MINUTES * 60 // 2
+
+
+@lru_cache()
+def load_private_key(private_key_txt: str) -> serialization.SSHPrivateKeyTypes:
+    """Parse an OpenSSH private key, once per key.
+
+    Args:
+        private_key_txt: The private key, in OpenSSH format.
+
+    Returns:
+        The parsed key.
+    """
+    return serialization.load_ssh_private_key(private_key_txt.encode(), password=b"")
+
 
 class BearerAuth(requests.auth.AuthBase):
     """A Bearer (a.k.a. "token") authentication scheme.
@@ -25,23 +45,40 @@ class BearerAuth(requests.auth.AuthBase):
         settings = get_settings()
 
         # Generate keys with ssh-keygen -t rsa
-        private_key_txt = settings.PRIVATE_KEY
+        self.private_key = load_private_key(settings.PRIVATE_KEY)
 
-        self.private_key = serialization.load_ssh_private_key(
-            private_key_txt.encode(), password=b""
-        )
+        self._token: Optional[str] = None
+        self._expires_on = 0.0
+        self._lock = threading.Lock()
 
     def create_access_token(self) -> str:
-        """Create an access token."""
-        access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-        expire = datetime.utcnow() + access_token_expires
-        token_claims = {"sub": "usage-app", "exp": expire}
+        """Create an access token, reusing the last one for half of its lifetime.
+
+        Signing is an RSA operation, so we avoid doing it for every request.
+        """
+        with self._lock:
+            now = time.time()
+            if self._token is None or self._expires_on - now < TOKEN_REFRESH_MARGIN:
+                self._expires_on = now + ACCESS_TOKEN_EXPIRE_MINUTES * 60
+                token_claims = {"sub": "usage-app", "exp": int(self._expires_on)}
+                self._token = jwt.encode(
+                    token_claims, self.private_key, algorithm="RS256"  # type: ignore
+                )
+
+            return self._token
 
-        return jwt.encode(
-            token_claims, self.private_key, algorithm="RS256"  # type: ignore
-        )
+    def clear_token(self) -> None:
+        """Forget the cached token, so that the next request signs a new one."""
+        with self._lock:
+            self._token = None
 
     def __call__(self, r: requests.PreparedRequest) -> requests.PreparedRequest:
         """Add the bearer token to the request."""
         r.headers["authorization"] = "Bearer " + self.create_access_token()
         return r
+
+
+@lru_cache()
+def get_auth() -> BearerAuth:
+    """Get the auth shared by every upload, so that they can share tokens."""
+    return BearerAuth()
@@ -7,6 +7,9 @@ from opencensus.ext.azure.log_exporter import AzureLogHandler
 
 import utils.settings
 
+# The names of loggers that already have an AzureLogHandler.
+CONFIGURED_LOGGERS: set[str] = set()
+
 
 class CustomDimensionsFilter(logging.Filter):
     """Add application-wide properties to AzureLogHandler records."""
@@ -36,12 +39,17 @@ def add_log_handler_once(name: str = "usage_function") -> None:
     Args:
       name : Name of the logger instance to which we add the log handler.
     """
+    # Called on every invocation, so skip the checks below once we're set up.
+    if name in CONFIGURED_LOGGERS:
+        return
+
     logger = logging.getLogger(name)
     settings = utils.settings.get_settings()
     if settings.CENTRAL_LOGGING_CONNECTION_STRING:
         for handler in logger.handlers:
             # Only allow one AzureLogHandler per logger
             if isinstance(handler, AzureLogHandler):
+                CONFIGURED_LOGGERS.add(name)
                 return
 
         custom_dimensions = {"logger_name": f"logger_{name}"}
@@ -50,3 +58,4 @@ def add_log_handler_once(name: str = "usage_function") -> None:
         )
         handler.addFilter(CustomDimensionsFilter(custom_dimensions))
         logger.addHandler(handler)
+        CONFIGURED_LOGGERS.add(name)
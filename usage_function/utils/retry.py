@@ -0,0 +1,47 @@
+"""Utils for retrying failed requests to Azure and to the API."""
+
+import random
+from typing import Optional
+
+# The first retry waits up to BACKOFF_BASE seconds, doubling with each attempt
+# up to BACKOFF_CAP seconds.
+BACKOFF_BASE = 2
+BACKOFF_CAP = 60
+
+# Response codes that indicate a transient failure, worth retrying.
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+
+def is_retryable(status_code: Optional[int]) -> bool:
+    """Check whether a failed request is worth retrying.
+
+    Args:
+        status_code: The response code, or None if there was no response.
+
+    Returns:
+        True if the failure may be transient, False if retrying would fail again.
+    """
+    return status_code is None or status_code in RETRYABLE_STATUS_CODES
+
+
+def backoff_delay(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Get how long to wait before retrying, using exponential backoff with jitter.
+
+    Jitter stops many failed clients from retrying in lockstep.
+
+    Args:
+        attempt: The number of failed attempts so far, minus one.
+        retry_after: The value of a Retry-After header, if the server sent one.
+
+    Returns:
+        The number of seconds to wait.
+    """
+    if retry_after is not None:
+        try:
+            # Retry-After may also be an HTTP date, which we ignore.
+            return min(BACKOFF_CAP, max(0.0, float(retry_after)))
+        except ValueError:
+            pass
+
+    delay = min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt)
+    return delay * (0.5 + random.random() * 0.5)
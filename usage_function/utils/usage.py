@@ -10,14 +10,42 @@ import requests
 from azure.identity import DefaultAzureCredential
 from azure.mgmt.consumption import ConsumptionManagementClient
 from azure.mgmt.consumption.models import UsageDetailsListResult
+from pydantic import TypeAdapter
 from pydantic_core import Url
 from rctab_models import models
 
-from utils.auth import BearerAuth
+from utils.auth import get_auth
 
 # We should only need one set of credentials
 CREDENTIALS = DefaultAzureCredential(exclude_shared_token_cache_credential=True)
 
+# Reuse connections, rather than doing a TCP and TLS handshake for every request.
+# requests doesn't document Session as thread-safe, but the usage function's
+# worker threads share this one on purpose. It is only used for stateless POSTs
+# that pass their own auth, and its settings are never changed, so all they share
+# is urllib3's thread-safe connection pool.
+SESSION = requests.Session()
+
+# Builds a list of Usage models from a list of dicts.
+USAGE_LIST_ADAPTER = TypeAdapter(list[models.Usage])
+
+# Serialises AllUsage straight to UTF-8 encoded JSON bytes.
+ALL_USAGE_ADAPTER = TypeAdapter(models.AllUsage)
+
+ONE_DAY = timedelta(days=1)
+
+# When the current invocation started, as set by start_run_timer().
+_RUN_START: Optional[datetime] = None
+
+# The fields, other than cost, that we add up when combining usage rows.
+SUMMED_FIELDS = (
+    "quantity",
+    "effective_price",
+    "amortised_cost",
+    "total_cost",
+    "unit_price",
+)
+
 
 def date_range(
     start_date: datetime, end_date: datetime
@@ -28,8 +56,37 @@ def date_range(
         start_date: First date included in range.
         end_date: Last date included in range.
     """
-    for n in range(int((end_date - start_date).days + 1)):
-        yield datetime.combine(start_date.date() + timedelta(n), datetime.min.time())
+    day = datetime.combine(start_date.date(), datetime.min.time())
+    for _ in range((end_date - start_date).days + 1):
+        yield day
+        day += ONE_DAY
+
+
+def date_range_desc(
+    start_date: datetime, end_date: datetime
+) -> Generator[datetime, None, None]:
+    """Yield a datetime day for each day between end_date and start_date (inclusive).
+
+    This is date_range() in reverse, without having to make a list of the days first.
+
+    Args:
+        start_date: Earliest date included in range, yielded last.
+        end_date: Latest date included in range, yielded first.
+    """
+    days = (end_date - start_date).days
+    day = datetime.combine(start_date.date(), datetime.min.time()) + timedelta(days)
+    for _ in range(days + 1):
+        yield day
+        day -= ONE_DAY
+
+
+@lru_cache()
+def get_consumption_client() -> ConsumptionManagementClient:
+    """Get a consumption client to share between calls, and their connections."""
+    # It doesn't matter which subscription ID we use for this bit.
+    return ConsumptionManagementClient(
+        credential=CREDENTIALS, subscription_id=str(UUID(int=0))
+    )
 
 
 def get_all_usage(
@@ -46,18 +103,13 @@ def get_all_usage(
         billing_account_id: Billing Account ID.
         mgmt_group: The name of a management group.
     """
-    # It doesn't matter which subscription ID we use for this bit.
-    consumption_client = ConsumptionManagementClient(
-        credential=CREDENTIALS, subscription_id=str(UUID(int=0))
-    )
+    consumption_client = get_consumption_client()
 
-    filter_from = "properties/usageEnd ge '{}'".format(
-        start_time.strftime("%Y-%m-%dT%H:%M:%SZ")
-    )
-    filter_to = "properties/usageEnd le '{}'".format(
-        end_time.strftime("%Y-%m-%dT%H:%M:%SZ")
+    # Our datetimes are naive, so isoformat() has no UTC offset to replace with Z.
+    filter_expression = (
+        f"properties/usageEnd ge '{start_time.isoformat(timespec='seconds')}Z' and "
+        f"properties/usageEnd le '{end_time.isoformat(timespec='seconds')}Z'"
     )
-    filter_expression = "{} and {}".format(filter_from, filter_to)
 
     scope_expression = ""
     if billing_account_id:
@@ -82,25 +134,14 @@ def get_all_usage(
     return data
 
 
-def combine_items(item_to_update: models.Usage, other_item: models.Usage) -> None:
-    """Update one Usage with the cost, etc. of another Usage."""
-    item_to_update.quantity = (item_to_update.quantity or 0) + (
-        other_item.quantity or 0
-    )
-    item_to_update.effective_price = (item_to_update.effective_price or 0) + (
-        other_item.effective_price or 0
-    )
-    item_to_update.amortised_cost = (item_to_update.amortised_cost or 0) + (
-        other_item.amortised_cost or 0
-    )
-    item_to_update.total_cost = (item_to_update.total_cost or 0) + (
-        other_item.total_cost or 0
-    )
-    item_to_update.unit_price = (item_to_update.unit_price or 0) + (
-        other_item.unit_price or 0
-    )
+def combine_items(item_to_update: dict, other_item: dict) -> None:
+    """Update one usage row with the cost, etc. of another usage row."""
+    for field in SUMMED_FIELDS:
+        item_to_update[field] = (item_to_update.get(field) or 0) + (
+            other_item.get(field) or 0
+        )
 
-    item_to_update.cost += other_item.cost
+    item_to_update["cost"] += other_item["cost"]
 
 
 def retrieve_usage(
@@ -108,6 +149,9 @@ def retrieve_usage(
 ) -> list[models.Usage]:
     """Retrieve usage data from Azure.
 
+    Rows with the same id are summed before validation, so that we only build
+    one Usage model per id.
+
     Args:
         usage_data models.UsageData: Usage data object.
 
@@ -116,7 +160,7 @@ def retrieve_usage(
     """
     logging.warning("Retrieve items")
 
-    all_items: Dict[str, models.Usage] = {}
+    all_items: Dict[str, dict] = {}
     started_processing_at = datetime.now()
 
     for i, item in enumerate(usage_data):
@@ -129,23 +173,21 @@ def retrieve_usage(
         # for reserved instances are not zero, thus the cost value is moved to
         # amortised_cost
         item_dict["total_cost"] = item_dict["cost"]
-
-        usage_item = models.Usage(**item_dict)
-
-        if usage_item.reservation_id is not None:
-            usage_item.amortised_cost = usage_item.cost
-            usage_item.cost = 0.0
+        if item_dict.get("reservation_id") is not None:
+            item_dict["amortised_cost"] = item_dict["cost"]
+            item_dict["cost"] = 0.0
         else:
-            usage_item.amortised_cost = 0.0
+            item_dict["amortised_cost"] = 0.0
 
-        if existing_item := all_items.get(usage_item.id):
+        if existing_item := all_items.get(item_dict["id"]):
             # Add to the existing item
-            combine_items(existing_item, usage_item)
+            combine_items(existing_item, item_dict)
 
         else:
-            all_items[usage_item.id] = usage_item
+            all_items[item_dict["id"]] = item_dict
 
-    all_item_list = list(all_items.values())
+    # Validate all items in one call, rather than building one model at a time.
+    all_item_list = USAGE_LIST_ADAPTER.validate_python(list(all_items.values()))
 
     logging.warning(
         "%d Usage objects retrieved in %s.",
@@ -170,17 +212,29 @@ def retrieve_and_send_usage(
     send_usage(hostname_or_ip, usage_list)
 
 
+def start_run_timer() -> None:
+    """Record the start of an invocation, as the worker process may be reused."""
+    global _RUN_START  # pylint: disable=global-statement
+    _RUN_START = datetime.now()
+
+
+def get_first_run_time() -> datetime:
+    """Get the time the current invocation started, for logging.
+
+    Raises:
+        RuntimeError: If start_run_timer() hasn't been called.
+    """
+    if _RUN_START is None:
+        raise RuntimeError("start_run_timer() must be called first.")
+    return _RUN_START
+
+
 def send_usage(
     hostname_or_ip: Url,
     all_item_list: list[models.Usage],
     monthly_usage_upload: bool = False,
 ) -> None:
     """Post each item of usage_data to a route."""
-
-    @lru_cache(1)
-    def get_first_run_time() -> datetime:
-        return datetime.now()
-
     started_processing_at = datetime.now()
 
     logging.warning("Upload all items")
@@ -189,16 +243,18 @@ def send_usage(
         path = "accounting/monthly-usage"
     else:
         path = "accounting/all-usage"
+    url = str(hostname_or_ip) + path
 
-    # Note that omitting the encoding appears to work but will
+    # Note that sending a str rather than UTF-8 bytes appears to work but will
     # fail server-side with some characters, such as en-dash.
-    data = models.AllUsage(usage_list=all_item_list).model_dump_json().encode("utf-8")
+    data = ALL_USAGE_ADAPTER.dump_json(models.AllUsage(usage_list=all_item_list))
 
+    auth = get_auth()
     for _ in range(2):
-        resp = requests.post(
-            str(hostname_or_ip) + path,
+        resp = SESSION.post(
+            url,
             data=data,
-            auth=BearerAuth(),
+            auth=auth,
             timeout=60,
         )
 
@@ -217,5 +273,8 @@ def send_usage(
             resp.status_code,
             resp.text,
         )
+        if resp.status_code == 401:
+            # The token may have expired during a slow upload, so sign a new one.
+            auth.clear_token()
 
     raise RuntimeError("Could not POST usage data.")